@@ -1,13 +1,27 @@
+import atexit
+import logging
 import requests
+import threading
 import time
 import csv
+import gzip
 import os
-import json
+import queue
+import io
+import orjson
 import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 DB_NAME = "pft_tracker"
 DB_USER = "milk"
 DB_PASSWORD = os.getenv("db_pw")  # leave blank if you're using peer auth
@@ -43,19 +57,47 @@ def create_table_if_not_exists(conn):
 XRPL_NODE_URL = "http://s1.ripple.com:51234/"
 ISSUER_ADDRESS = "rnQUEEg8yyjrwk9FhyXpKavHyCRJM9BDMW"
 PFT_CURRENCY_CODE = "PFT"
+SCALE = 10**6  # Balances are held as integer millionths of a PFT
+FETCH_WORKERS = 16  # Concurrent account_tx requests per day
+BATCH_SIZE = 20  # Addresses per batched account_tx request
+batch_supported = True  # Cleared once the node answers a batch request without one
+# Scan every ledger instead of polling account_tx for each watchlist address.
+# API work becomes O(ledgers) rather than O(watchlist), at 22.7k requests a day.
+SCAN_LEDGERS = False
+# Stop re-querying empty addresses with no PFT activity for this many days.
+# Only zero-balance addresses are skipped, and one that shows up in a day's
+# Payments is re-queried that same day so an onward payment isn't lost. PFT that
+# arrives some other way (e.g. a DEX trade) isn't tracked, so a skipped address
+# that spends it without first receiving a Payment that day is still missed.
+DORMANT_AFTER_DAYS = 30
 
 LEDGERS_PER_DAY = 22700
 START_LEDGER = 87570565
-BALANCES_CSV = "pft_balances_full.csv"
+BALANCES_PARQUET = "pft_balances_full.parquet"
 TRANSFERS_CSV = "pft_daily_transfers_full.csv"
 DAILY_ACTIVE_CSV = "pft_daily_active.csv"
 CIRCULATING_SUPPLY_CSV = "pft_circulating_supply.csv"
 CHECKPOINT_FILE = "checkpoint.txt"
+CSV_BUFFER_SIZE = 1 << 20
+
+# Addresses repeat heavily, so Parquet's dictionary encoding keeps them small
+BALANCES_SCHEMA = pa.schema(
+    [
+        ("day", pa.int32()),
+        ("address", pa.string()),
+        ("balance", pa.decimal128(38, 6)),
+    ]
+)
 
 
 # Initial watchlist (starts with issuer)
+# Kept as an exact set: it is also the list of addresses we query, and a
+# probabilistic filter's false positives would silently drop new addresses.
 watchlist = set([ISSUER_ADDRESS])
 
+# Last day each address sent or received PFT
+last_active = {}
+
 
 def load_checkpoint():
     if os.path.exists(CHECKPOINT_FILE):
@@ -69,10 +111,10 @@ def save_checkpoint(day_number):
         f.write(str(day_number))
 
 
-# Helper: get ledger range for a given day
+# Helper: get ledger range for a given day (inclusive, as account_tx treats it)
 def get_ledger_range_for_day(day_number):
     ledger_min = START_LEDGER + (day_number * LEDGERS_PER_DAY)
-    ledger_max = ledger_min + LEDGERS_PER_DAY
+    ledger_max = ledger_min + LEDGERS_PER_DAY - 1
     return ledger_min, ledger_max
 
 
@@ -80,66 +122,230 @@ def get_ledger_range_for_day(day_number):
 api_call_count = 0
 log_file_index = 0
 RESPONSES_LOG_TEMPLATE = "api_responses_log_{}.txt"
+LOG_BUFFER_SIZE = 1 << 20
+log_lock = threading.Lock()
 
 
-def safe_post(payload):
-    global api_call_count, log_file_index
-
-    response = requests.post(
-        XRPL_NODE_URL, headers={"Content-Type": "application/json"}, json=payload
+# Helper: open the response log for the current index
+# Level 1 gzip is cheap on CPU and still shrinks the JSON several times over.
+def open_log(index):
+    return io.BufferedWriter(
+        gzip.open(RESPONSES_LOG_TEMPLATE.format(index) + ".gz", "ab", compresslevel=1),
+        buffer_size=LOG_BUFFER_SIZE,
     )
 
-    if response.status_code == 200:
-        data = response.json()
 
-        # Check for server warnings
-        # if "warnings" in data:
-        #     for warning in data["warnings"]:
-        # print(f"Server warning: {warning['message']}")
+# Keep one buffered handle open instead of reopening the log per call
+LOG_FH = open_log(log_file_index)
+
+# Responses are handed to a writer thread so logging doesn't hold up requests
+LOG_Q = queue.Queue(maxsize=1024)
+LOG_STOP = object()  # Sentinel telling the writer thread to exit
+LOG_CLOSE_TIMEOUT = 30  # seconds
+
 
-        # Log the full response
-        logfile_name = RESPONSES_LOG_TEMPLATE.format(log_file_index)
-        with open(logfile_name, mode="a", encoding="utf-8") as logfile:
-            logfile.write(json.dumps(data))
-            logfile.write("\n")  # newline between entries
+# Helper: append one response to the log, rotating every 1000 API calls
+def write_log(data):
+    global api_call_count, log_file_index, LOG_FH
+
+    with log_lock:
+        if LOG_FH.closed:
+            LOG_FH = open_log(log_file_index)  # an earlier rotation failed part-way
+
+        LOG_FH.write(orjson.dumps(data))
+        LOG_FH.write(b"\n")  # newline between entries
 
         api_call_count += 1
 
-        # Rotate log every 1000 API calls
         if api_call_count >= 1000:
             api_call_count = 0
-            log_file_index += 1
+            try:
+                LOG_FH.close()
+            finally:
+                log_file_index += 1
+                LOG_FH = open_log(log_file_index)
+
+
+def log_writer():
+    while True:
+        data = LOG_Q.get()
+        if data is LOG_STOP:
+            return
+        try:
+            write_log(data)
+        except Exception:
+            # Keep draining: a dead writer would leave the queue full for good
+            log.exception("Failed to write API response log")
+
+
+# Helper: drain and close the log at exit, without waiting forever on a stuck writer
+def close_log():
+    try:
+        LOG_Q.put(LOG_STOP, timeout=LOG_CLOSE_TIMEOUT)
+    except queue.Full:
+        log.warning("Response log queue still full at exit; dropping the rest")
+    LOG_THREAD.join(timeout=LOG_CLOSE_TIMEOUT)
+
+    if log_lock.acquire(timeout=LOG_CLOSE_TIMEOUT):
+        try:
+            LOG_FH.close()
+        finally:
+            log_lock.release()
+
+
+LOG_THREAD = threading.Thread(target=log_writer, daemon=True)
+LOG_THREAD.start()
+atexit.register(close_log)
+
+# Pacing delay (seconds) shared by workers while rippled reports load; see update_pace
+pace = 0
+pace_lock = threading.Lock()
+PACE_DECAY = 0.8  # Fraction of the pace kept after each clean response
+MAX_BACKOFF = 8
+MAX_RETRIES = 5
+# rippled errors that mean "try again shortly" rather than a bad request
+RETRYABLE_ERRORS = {"slowDown", "tooBusy", "noNetwork", "noCurrent"}
+seen_warnings = set()
+
+# Shared HTTP session so worker threads reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+REQUEST_TIMEOUT = 60  # seconds; a stalled socket shouldn't hang a worker forever
+
+
+# Helper: detect rippled asking us to slow down
+# Returns (retry, pace): retry when the request was refused or hit a temporary
+# server error, pace on a "load" warning.
+def check_load(status_code, data):
+    if status_code == 503:
+        return True, True
+
+    result = data.get("result") if isinstance(data, dict) else None
+    if not isinstance(result, dict):
+        return False, False
+
+    if result.get("error") in RETRYABLE_ERRORS:
+        return True, True
+    return False, data.get("warning") == "load" or result.get("warning") == "load"
+
+
+# Helper: double the shared pace on load, let it decay while the server is happy
+# Shared across workers since rippled rate-limits per client, not per request.
+# Decaying (rather than zeroing) keeps one worker's clean reply from undoing it.
+def update_pace(loaded, load_factor=None):
+    global pace
 
-        return data
+    with pace_lock:
+        if loaded:
+            pace = min(MAX_BACKOFF, max(pace * 2, 0.5))
+        else:
+            pace = pace * PACE_DECAY if pace > 0.05 else 0
+        delay = pace
 
-    else:
-        print(f"Request failed: {response.status_code} - {response.text}")
-        return None
+    if loaded and load_factor and load_factor > 1:
+        delay = min(MAX_BACKOFF, delay * load_factor)
+    return delay
+
+
+def safe_post(payload):
+    body = orjson.dumps(payload)
+    retry_delay = 0  # Per-call backoff for refused requests
+
+    for _ in range(MAX_RETRIES + 1):
+        try:
+            response = SESSION.post(
+                XRPL_NODE_URL,
+                headers={"Content-Type": "application/json"},
+                data=body,
+                timeout=REQUEST_TIMEOUT,
+            )
+            data = None
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            # Stalled/reset socket or a truncated body: retry like a 503
+            retry_delay = min(MAX_BACKOFF, max(retry_delay * 2, 0.5))
+            delay = max(retry_delay, update_pace(True))
+            log.warning("Request error, retrying in %.1fs: %s", delay, e)
+            time.sleep(delay)
+            continue
+
+        if response.status_code == 200:
+            # Log the full response
+            try:
+                LOG_Q.put_nowait(data)
+            except queue.Full:
+                # Writer is behind; log inline rather than block
+                try:
+                    write_log(data)
+                except Exception:
+                    log.exception("Failed to write API response log")
+
+            # Check for server warnings (each distinct one is reported once)
+            if isinstance(data, dict):
+                for warning in data.get("warnings", []):
+                    message = warning.get("message")
+                    if message not in seen_warnings:
+                        seen_warnings.add(message)
+                        log.warning("Server warning: %s", message)
+
+        elif response.status_code != 503:
+            log.warning("Request failed: %s - %s", response.status_code, response.text)
+            return None
+
+        retry, loaded = check_load(response.status_code, data)
+        result = data.get("result") if isinstance(data, dict) else None
+        load_factor = result.get("load_factor") if isinstance(result, dict) else None
+        delay = update_pace(loaded, load_factor)
+
+        if not retry:
+            if isinstance(result, dict) and result.get("status") == "error":
+                log.warning(
+                    "%s failed: %s",
+                    payload.get("method"),
+                    result.get("error_message") or result.get("error"),
+                )
+            if delay:
+                time.sleep(delay)  # pace this worker's next call
+            return data
+
+        retry_delay = min(MAX_BACKOFF, max(retry_delay * 2, 0.5))
+        delay = max(retry_delay, delay)
+        log.warning("Server overloaded, retrying in %.1fs", delay)
+        time.sleep(delay)
+
+    log.warning("Giving up after %d retries", MAX_RETRIES)
+    return None
+
+
+# Helper: build account_tx params for an address
+def account_tx_params(address, ledger_min, ledger_max, marker=None):
+    params = {
+        "account": address,
+        "ledger_index_min": ledger_min,
+        "ledger_index_max": ledger_max,
+        "binary": False,
+        "limit": 500,
+        "forward": True,
+        # Clio-backed servers filter server-side; rippled ignores the field
+        "tx_type": "Payment",
+    }
+
+    if marker:
+        params["marker"] = marker
+
+    return params
 
 
 # Helper: fetch account_tx for an address
-def fetch_account_transactions(address, ledger_min, ledger_max):
+def fetch_account_transactions(address, ledger_min, ledger_max, marker=None):
     all_transactions = []
-    marker = None
 
-    while True:
-        payload = {
-            "method": "account_tx",
-            "params": [
-                {
-                    "account": address,
-                    "ledger_index_min": ledger_min,
-                    "ledger_index_max": ledger_max,
-                    "binary": False,
-                    "limit": 500,
-                    "forward": True,
-                }
-            ],
-        }
-
-        if marker:
-            payload["params"][0]["marker"] = marker
+    # Built once; only the marker changes between pages
+    params = account_tx_params(address, ledger_min, ledger_max, marker)
+    payload = {"method": "account_tx", "params": [params]}
 
+    while True:
         data = safe_post(payload)
 
         if not data:
@@ -152,15 +358,125 @@ def fetch_account_transactions(address, ledger_min, ledger_max):
         marker = result.get("marker")
         if not marker:
             break
-
-        time.sleep(0.5)  # Gentle pacing between requests
+        params["marker"] = marker
 
     return all_transactions
 
 
+# Helper: fetch the first account_tx page for several addresses in one request
+# rippled's "batch" method answers with one result per sub-request, in order.
+# Addresses that need more pages (or that errored) finish with the per-address loop.
+def fetch_account_transactions_batch(addresses, ledger_min, ledger_max):
+    global batch_supported
+
+    if not batch_supported:
+        return fetch_each_account(addresses, ledger_min, ledger_max)
+
+    payload = {
+        "method": "batch",
+        "params": [
+            {
+                "method": "account_tx",
+                "params": [account_tx_params(address, ledger_min, ledger_max)],
+            }
+            for address in addresses
+        ],
+    }
+
+    data = safe_post(payload)
+    replies = data.get("result") if isinstance(data, dict) else data
+
+    if not isinstance(replies, list) or len(replies) != len(addresses):
+        if data is not None:
+            # The node answered but not as a batch; stop probing it
+            log.warning("Node doesn't support batch; using per-address requests")
+            batch_supported = False
+        return fetch_each_account(addresses, ledger_min, ledger_max)
+
+    results = {}
+    for address, reply in zip(addresses, replies):
+        result = reply.get("result", reply) if isinstance(reply, dict) else None
+
+        if not isinstance(result, dict) or result.get("status", "success") != "success":
+            results[address] = fetch_account_transactions(
+                address, ledger_min, ledger_max
+            )
+            continue
+
+        transactions = result.get("transactions", [])
+        marker = result.get("marker")
+        if marker:
+            transactions = transactions + fetch_account_transactions(
+                address, ledger_min, ledger_max, marker
+            )
+        results[address] = transactions
+
+    return results
+
+
+# Helper: fetch account_tx one address at a time
+def fetch_each_account(addresses, ledger_min, ledger_max):
+    return {
+        address: fetch_account_transactions(address, ledger_min, ledger_max)
+        for address in addresses
+    }
+
+
+# Helper: fetch account_tx for many addresses across the worker pool
+# Yields each address's transactions in submission order.
+def fetch_accounts(executor, addresses, ledger_min, ledger_max):
+    futures = [
+        executor.submit(
+            fetch_account_transactions_batch,
+            addresses[i : i + BATCH_SIZE],
+            ledger_min,
+            ledger_max,
+        )
+        for i in range(0, len(addresses), BATCH_SIZE)
+    ]
+    for future in futures:
+        yield from future.result().values()
+
+
+# Helper: fetch the PFT payments in a single ledger
+# Filtered here so only PFT entries, not whole ledgers, are held until the day ends.
+# Reshaped to match account_tx entries so the rest of the pipeline is shared.
+def fetch_ledger_transactions(ledger_index):
+    payload = {
+        "method": "ledger",
+        "params": [
+            {
+                "ledger_index": ledger_index,
+                "transactions": True,
+                "expand": True,
+            }
+        ],
+    }
+
+    data = safe_post(payload)
+
+    if not data:
+        return []
+
+    ledger = data.get("result", {}).get("ledger", {})
+    transactions = []
+    for entry in ledger.get("transactions", []):
+        if not is_pft_payment(entry):
+            continue
+
+        # Copy rather than mutate: the response may still be queued for the log
+        tx_data = {
+            "ledger_index": ledger_index,
+            "date": ledger.get("close_time", ""),
+            **entry,
+        }
+        transactions.append({"tx": tx_data, "meta": tx_data.pop("metaData", None)})
+
+    return transactions
+
+
 # Helper: check if a transaction is a PFT payment
-def is_pft_payment(tx):
-    tx_data = tx.get("tx", {})
+def is_pft_payment(tx_data):
     if tx_data.get("TransactionType") != "Payment":
         return False
     amount = tx_data.get("Amount")
@@ -174,26 +490,59 @@ def is_pft_payment(tx):
 
 active_addresses = set()
 
+# Running sum of positive balances, kept in step with update_balances
+positive_supply = 0
+
+
+# Helper: parse an XRPL amount string into integer units of 1/SCALE PFT
+def to_units(value):
+    return int((Decimal(value) * SCALE).to_integral_value())
+
+
+# Helper: render integer units back as an exact decimal PFT amount
+def from_units(units):
+    return Decimal(units) / SCALE
+
 
 # Helper: update balances
 def update_balances(balances, tx, active_addresses):
+    global positive_supply
+
     tx_data = tx["tx"]
     amount_data = tx_data["Amount"]
-    amount = float(amount_data["value"])
+    amount = to_units(amount_data["value"])
 
     sender = tx_data["Account"]
     receiver = tx_data["Destination"]
-    active_addresses.update([sender, receiver])
-
-    balances[sender] = balances.get(sender, 0) - amount
-    balances[receiver] = balances.get(receiver, 0) + amount
-
-
-# Helper: save daily balances
-def save_balances_to_csv(day_number, balances, csv_writer):
-    for address, balance in balances.items():
-        if balance != 0:  # Save only active balances
-            csv_writer.writerow([day_number, address, balance])
+    active_addresses.add(sender)
+    active_addresses.add(receiver)
+
+    before_sender = balances[sender]
+    balances[sender] -= amount
+    positive_supply += max(balances[sender], 0) - max(before_sender, 0)
+
+    before_receiver = balances[receiver]
+    balances[receiver] += amount
+    positive_supply += max(balances[receiver], 0) - max(before_receiver, 0)
+
+
+# Helper: save balances that changed today as one Parquet row group
+# Rows are a diff: carry each address's last row forward to rebuild a full snapshot.
+# Zero balances are still written so a drained address doesn't carry a stale value.
+def save_balances(day_number, balances, changed_addresses, parquet_writer):
+    if not changed_addresses:
+        return
+
+    addresses = list(changed_addresses)
+    table = pa.Table.from_pydict(
+        {
+            "day": [day_number] * len(addresses),
+            "address": addresses,
+            "balance": [from_units(balances[address]) for address in addresses],
+        },
+        schema=BALANCES_SCHEMA,
+    )
+    parquet_writer.write_table(table)
 
 
 # Helper: save daily transfer counts
@@ -201,123 +550,213 @@ def save_transfer_count(day_number, transfer_count, csv_writer):
     csv_writer.writerow([day_number, transfer_count])
 
 
-def insert_transfer(conn, tx, day_number):
+# Helper: build a pft_transfers row for a transaction
+def transfer_row(tx, day_number):
     tx_data = tx["tx"]
-    amount = float(tx_data["Amount"]["value"])
-    sender = tx_data["Account"]
-    receiver = tx_data["Destination"]
-    tx_hash = tx_data["hash"]
-    ledger_index = tx_data["ledger_index"]
-    timestamp = tx_data.get("date", "")
+    return (
+        tx_data["hash"],
+        day_number,
+        tx_data["ledger_index"],
+        tx_data["Account"],
+        tx_data["Destination"],
+        Decimal(tx_data["Amount"]["value"]),
+        tx_data.get("date", ""),
+    )
 
-    with conn.cursor() as cur:
-        try:
-            cur.execute(
-                """
-                INSERT INTO pft_transfers (tx_hash, day, ledger_index, sender, receiver, amount, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (tx_hash) DO NOTHING;
-            """,
-                (
-                    tx_hash,
-                    day_number,
-                    ledger_index,
-                    sender,
-                    receiver,
-                    amount,
-                    timestamp,
-                ),
-            )
-        except Exception as e:
-            print(f"DB insert failed for {tx_hash}: {e}")
 
+# Helper: bulk-load a day's transfers with COPY
+# COPY can't skip conflicts, so rows land in a temp table first and are
+# merged with ON CONFLICT DO NOTHING (a tx seen from both sides, or a rerun day).
+def insert_transfers(cur, rows):
+    if not rows:
+        return
 
-# ---- MAIN ----
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(str(value) for value in row))
+        buf.write("\n")
+    buf.seek(0)
 
+    try:
+        cur.execute(
+            """
+            CREATE TEMP TABLE IF NOT EXISTS pft_transfers_staging
+            (LIKE pft_transfers INCLUDING DEFAULTS)
+            ON COMMIT DELETE ROWS;
+        """
+        )
+        cur.copy_expert(
+            "COPY pft_transfers_staging (tx_hash, day, ledger_index, sender, receiver, amount, timestamp) FROM STDIN WITH (FORMAT text)",
+            buf,
+        )
+        cur.execute(
+            """
+            INSERT INTO pft_transfers (tx_hash, day, ledger_index, sender, receiver, amount, timestamp)
+            SELECT tx_hash, day, ledger_index, sender, receiver, amount, timestamp
+            FROM pft_transfers_staging
+            ON CONFLICT (tx_hash) DO NOTHING;
+        """
+        )
+    except Exception as e:
+        log.error("DB insert failed for %d transfers: %s", len(rows), e)
+        cur.connection.rollback()
 
-def main():
-    conn = connect_db()
-    create_table_if_not_exists(conn)
-
-    start_day = load_checkpoint()  # Day 0 = April 26, 2024
-    number_of_days = 368  # Start small, expand later
-    balances = {}
-    new_addresses = set()
-
-    # Open CSVs
-    with (
-        open(BALANCES_CSV, mode="w", newline="") as balances_csvfile,
-        open(TRANSFERS_CSV, mode="w", newline="") as transfers_csvfile,
-        open(DAILY_ACTIVE_CSV, mode="w", newline="") as active_csvfile,
-        open(CIRCULATING_SUPPLY_CSV, mode="w", newline="") as supply_csvfile,
-    ):
-
-        balances_writer = csv.writer(balances_csvfile)
-        transfers_writer = csv.writer(transfers_csvfile)
-        active_writer = csv.writer(active_csvfile)
-        supply_writer = csv.writer(supply_csvfile)
-
-        balances_writer.writerow(["day", "address", "balance"])
-        transfers_writer.writerow(["day", "pft_transfer_count"])
-        active_writer.writerow(["day", "active_address_count"])
-        supply_writer.writerow(["day", "circulating_supply"])
-
-        for day_offset in range(number_of_days):
-            active_addresses = set()
-            day_number = start_day + day_offset
-            ledger_min, ledger_max = get_ledger_range_for_day(day_number)
-
-            print(
-                f"\nProcessing Day {day_number}: Ledgers {ledger_min} to {ledger_max}"
-            )
-            pft_transfer_count = 0
 
-            # Track addresses for this day
-            day_addresses = set(watchlist)
+# Helper: apply fetched transactions to the day's state, returning the transfer count
+def process_transactions(
+    day_results, day_number, balances, active_addresses, day_hashes, day_rows
+):
+    transfer_count = 0
 
-            for address in day_addresses:
-                transactions = fetch_account_transactions(
-                    address, ledger_min, ledger_max
-                )
+    for transactions in day_results:
+        for tx in transactions:
+            tx_data = tx.get("tx", {})
+            if not is_pft_payment(tx_data):
+                continue
 
-                for tx in transactions:
-                    if is_pft_payment(tx):
-                        tx_hash = tx["tx"]["hash"]
-                        # print(f"PFT transfer found, {tx_hash}")
-                        insert_transfer(conn, tx, day_number)
+            # A transfer between two watched addresses comes back for both
+            tx_hash = tx_data["hash"]
+            if tx_hash in day_hashes:
+                continue
+            day_hashes.add(tx_hash)
 
-                        update_balances(balances, tx, active_addresses)
-                        pft_transfer_count += 1
+            day_rows.append(transfer_row(tx, day_number))
+            update_balances(balances, tx, active_addresses)
+            transfer_count += 1
 
-                        sender = tx["tx"]["Account"]
-                        receiver = tx["tx"]["Destination"]
+    return transfer_count
 
-                        if sender not in watchlist:
-                            new_addresses.add(sender)
-                        if receiver not in watchlist:
-                            new_addresses.add(receiver)
 
-            # Expand watchlist
-            watchlist.update(new_addresses)
-            new_addresses.clear()
+# ---- MAIN ----
 
-            # Save daily output
-            save_balances_to_csv(day_number, balances, balances_writer)
-            save_transfer_count(day_number, pft_transfer_count, transfers_writer)
-            active_writer.writerow([day_number, len(active_addresses)])
-            total_supply = sum(balance for balance in balances.values() if balance > 0)
-            supply_writer.writerow([day_number, total_supply])
 
-            save_checkpoint(day_number + 1)
-            if (day_number + 1) % 10 == 0:
-                print(f"✅ Completed {day_number + 1} days so far...")
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
 
-            if (day_number + 1) % 25 == 0:
-                print("⏸ Taking a short break to avoid overloading the server...")
-                time.sleep(300)  # 5 minutes
+    conn = connect_db()
+    create_table_if_not_exists(conn)
+    cur = conn.cursor()
+    executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
 
-    print(f"\nSaved all balances to {BALANCES_CSV}")
-    print(f"Saved all transfer counts to {TRANSFERS_CSV}")
+    start_day = load_checkpoint()  # Day 0 = April 26, 2024
+    number_of_days = 368  # Start small, expand later
+    balances = defaultdict(int)
+
+    try:
+        # Open outputs
+        with (
+            pq.ParquetWriter(
+                BALANCES_PARQUET, BALANCES_SCHEMA, compression="zstd"
+            ) as balances_writer,
+            open(
+                TRANSFERS_CSV, mode="w", newline="", buffering=CSV_BUFFER_SIZE
+            ) as transfers_csvfile,
+            open(
+                DAILY_ACTIVE_CSV, mode="w", newline="", buffering=CSV_BUFFER_SIZE
+            ) as active_csvfile,
+            open(
+                CIRCULATING_SUPPLY_CSV, mode="w", newline="", buffering=CSV_BUFFER_SIZE
+            ) as supply_csvfile,
+        ):
+
+            transfers_writer = csv.writer(transfers_csvfile)
+            active_writer = csv.writer(active_csvfile)
+            supply_writer = csv.writer(supply_csvfile)
+
+            transfers_writer.writerow(["day", "pft_transfer_count"])
+            active_writer.writerow(["day", "active_address_count"])
+            supply_writer.writerow(["day", "circulating_supply"])
+
+            for day_offset in range(number_of_days):
+                active_addresses = set()
+                day_number = start_day + day_offset
+                ledger_min, ledger_max = get_ledger_range_for_day(day_number)
+
+                log.info(
+                    "Processing day %d: ledgers %d to %d",
+                    day_number,
+                    ledger_min,
+                    ledger_max,
+                )
+                pft_transfer_count = 0
+                day_rows = []
+                day_hashes = set()
+
+                # Fetch concurrently, process serially (DB/balances aren't thread-safe)
+                if SCAN_LEDGERS:
+                    # One pass over the day's ledgers: each tx is seen exactly once
+                    futures = [
+                        executor.submit(fetch_ledger_transactions, ledger_index)
+                        for ledger_index in range(ledger_min, ledger_max + 1)
+                    ]
+                    pft_transfer_count += process_transactions(
+                        (future.result() for future in futures),
+                        day_number,
+                        balances,
+                        active_addresses,
+                        day_hashes,
+                        day_rows,
+                    )
+                else:
+                    # Track addresses for this day, skipping dormant empty ones
+                    day_addresses = [
+                        address
+                        for address in watchlist
+                        if address == ISSUER_ADDRESS
+                        or balances.get(address, 0) > 0
+                        or address not in last_active
+                        or day_number - last_active[address] < DORMANT_AFTER_DAYS
+                    ]
+                    skipped = watchlist.difference(day_addresses)
+
+                    while day_addresses:
+                        pft_transfer_count += process_transactions(
+                            fetch_accounts(
+                                executor, day_addresses, ledger_min, ledger_max
+                            ),
+                            day_number,
+                            balances,
+                            active_addresses,
+                            day_hashes,
+                            day_rows,
+                        )
+
+                        # A skipped address that received PFT today may have passed
+                        # it on, so query those too until no more turn up
+                        day_addresses = list(skipped & active_addresses)
+                        skipped.difference_update(day_addresses)
+
+                insert_transfers(cur, day_rows)
+                conn.commit()
+
+                # Expand watchlist with today's senders/receivers not yet on it
+                new_addresses = active_addresses - watchlist
+                watchlist.update(new_addresses)
+                for address in active_addresses:
+                    last_active[address] = day_number
+
+                # Save daily output
+                save_balances(day_number, balances, active_addresses, balances_writer)
+                save_transfer_count(day_number, pft_transfer_count, transfers_writer)
+                active_writer.writerow([day_number, len(active_addresses)])
+                supply_writer.writerow([day_number, from_units(positive_supply)])
+
+                save_checkpoint(day_number + 1)
+                if (day_number + 1) % 10 == 0:
+                    log.info("Completed %d days so far", day_number + 1)
+
+                if (day_number + 1) % 25 == 0:
+                    log.info("Taking a short break to avoid overloading the server")
+                    time.sleep(300)  # 5 minutes
+    finally:
+        # Don't let queued fetches keep the process alive after an error
+        executor.shutdown(cancel_futures=True)
+
+    log.info("Saved all balances to %s", BALANCES_PARQUET)
+    log.info("Saved all transfer counts to %s", TRANSFERS_CSV)
+    cur.close()
     conn.commit()
     conn.close()
 